@@ -3,64 +3,325 @@ This module provides a FastAPI application that uses Playwright to fetch and ret
 the HTML content of a specified URL. It supports optional proxy settings and media blocking.
 """
 
-from os import environ
+import asyncio
+from collections import defaultdict
+from functools import lru_cache
+import json
+from os import environ, getpid, path, remove, replace
 import random
 import re
-from urllib.parse import urlencode, urlparse
+import sys
+import time
+from urllib.parse import quote_plus, urlencode
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from playwright.async_api import Browser, async_playwright
-from pydantic import BaseModel
-import requests
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from playwright.async_api import Browser, TimeoutError as PlaywrightTimeoutError, async_playwright
+from pydantic import BaseModel, ConfigDict
+from cachetools import TTLCache
+import httpx
 from get_error import get_error
 
+# Status-code error strings, resolved once so the hot paths do a dict lookup
+_ERROR_CACHE = {code: get_error(code) for code in range(100, 600)}
+
+try:
+    # The workload is dominated by CDP WebSocket and outbound HTTPS traffic;
+    # uvloop's libuv-backed loop handles that socket churn far better than
+    # the default selector loop.
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 BROWSERBASE_API_KEY = environ.get("BROWSERBASE_API_KEY")
 BROWSERBASE_PROJECT_ID = environ.get("BROWSERBASE_PROJECT_ID")
 OLOSTEP_API_KEY = environ.get("OLOSTEP_API_KEY")
 BLOCK_MEDIA = environ.get("BLOCK_MEDIA", "False").upper() == "TRUE"
+CONTEXT_POOL_SIZE = int(environ.get("CTX_POOL", "8"))
+CONTEXT_MAX_USES = int(environ.get("CONTEXT_MAX_USES", "100"))
+MAX_CONCURRENCY = int(environ.get("MAX_CONCURRENCY", "16"))
+HOST_CONCURRENCY = int(environ.get("HOST_CONCURRENCY", "2"))
+BB_POOL_SIZE = int(environ.get("BB_POOL_SIZE", "4"))
+REDDIT_STORAGE_STATE = environ.get("REDDIT_STORAGE_STATE", "reddit-state.json")
 PROXY_DOMAINS = ["crunchbase.com"]
 
-app = FastAPI()
-
-# Configure logging
+# Only the target URL varies between Olostep calls; the rest is rendered once
+_OLOSTEP_STATIC_QS = urlencode({
+    "timeout": "20",
+    "waitBeforeScraping": "1",
+    "saveHtml": "false",
+    "saveMarkdown": "false",
+    "removeCSSselectors": "default",
+    "htmlTransformer": "true",
+    "removeImages": "true",
+    "expandMarkdown": "false",
+    "expandHtml": "true",
+    "fastLane": "true",
+})
+_OLOSTEP_HEADERS = {"Authorization": f"Bearer {OLOSTEP_API_KEY}"}
+
+_TWEET_RE = re.compile(r"/status/(\d+)")
+_TWEET_URL_TMPL = "https://cdn.syndication.twimg.com/tweet-result?id={}&lang=en&features=tfw_timeline_list%3A%3Btfw_follower_count_sunset%3Atrue%3Btfw_tweet_edit_backend%3Aon%3Btfw_refsrc_session%3Aon%3Btfw_fosnr_soft_interventions_enabled%3Aon%3Btfw_show_birdwatch_pivots_enabled%3Aon%3Btfw_show_business_verified_badge%3Aon%3Btfw_duplicate_scribes_to_settings%3Aon%3Btfw_use_profile_image_shape_enabled%3Aon%3Btfw_show_blue_verified_badge%3Aon%3Btfw_legacy_timeline_sunset%3Atrue%3Btfw_show_gov_verified_badge%3Aon%3Btfw_show_business_affiliate_badge%3Aon%3Btfw_tweet_edit_frontend%3Aon&token=4c2mmul6mnh".format
+
+app = FastAPI(default_response_class=ORJSONResponse)
+# Page payloads are routinely 100KB+ of HTML; gzip them on the way out
+app.add_middleware(GZipMiddleware, minimum_size=2048, compresslevel=5)
+
+# Configure logging; records go through a queue so formatting (notably
+# traceback stringification) happens on a background thread, off the event loop
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, *logging.getLogger().handlers)
+_log_listener.start()
+logger.addHandler(QueueHandler(_log_queue))
+logger.propagate = False
 
 class UrlModel(BaseModel):
     """Model representing the URL and associated parameters for the request."""
+    model_config = ConfigDict(extra="forbid")
+
     url: str
     wait_after_load: int = 0
     timeout: int = 15000
-    headers: dict = None
+    headers: dict[str, str] | None = None
+    stream: bool = False
+    isolate: bool = False
 
 browser: Browser = None
+context_pool = None
+http_client: httpx.AsyncClient = None
+playwright_instance = None
+request_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+_host_semaphores: defaultdict = defaultdict(lambda: asyncio.Semaphore(HOST_CONCURRENCY))
+_inflight: dict = {}
+
+# Access records queue up here; one background task formats and writes them
+_access_log_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+_access_log_task = None
+
+def _log_access(url: str, status, start: float):
+    try:
+        _access_log_queue.put_nowait((url, status, time.perf_counter() - start))
+    except asyncio.QueueFull:
+        pass
+
+async def _drain_access_log():
+    """Batch-write access records so log formatting and I/O stay off the request path."""
+    while True:
+        records = [await _access_log_queue.get()]
+        while not _access_log_queue.empty():
+            records.append(_access_log_queue.get_nowait())
+        sys.stdout.write("".join(
+            json.dumps({
+                "url": url,
+                "host": _url_host(url),
+                "status": status,
+                "elapsed_ms": round(elapsed * 1000, 1),
+            }) + "\n"
+            for url, status, elapsed in records
+        ))
+
+# Domains that bypass the regular browser path, keyed by registrable domain
+_SPECIAL_DOMAINS = {
+    "twitter.com": "twitter",
+    "x.com": "twitter",
+    "reddit.com": "reddit",
+    "linkedin.com": "olostep",
+    "crunchbase.com": "olostep",
+    "dnb.com": "browserbase",
+}
+
+def _url_host(url: str) -> str:
+    """Extract the lowercased host from a URL without building a ParseResult."""
+    start = url.find("://")
+    start = start + 3 if start >= 0 else 0
+    # The authority ends at the first of "/", "?" or "#"; stopping only at
+    # "/" would let "https://evil.com?x@reddit.com" parse as "reddit.com"
+    end = len(url)
+    for sep in "/?#":
+        pos = url.find(sep, start)
+        if 0 <= pos < end:
+            end = pos
+    host = url[start:end]
+    at = host.rfind("@")
+    if at >= 0:
+        host = host[at + 1:]
+    colon = host.find(":")
+    if colon >= 0:
+        host = host[:colon]
+    return host.lower()
+
+@lru_cache(maxsize=4096)
+def classify_domain(host: str) -> str:
+    """Map a hostname (including subdomains) to its special-cased handler, if any."""
+    handler = _SPECIAL_DOMAINS.get(host)
+    if handler is None and host.count(".") >= 2:
+        # fall back to the registrable domain for subdomains like old.reddit.com
+        handler = _SPECIAL_DOMAINS.get(host.split(".", host.count(".") - 1)[-1])
+    return handler or "default"
+
+STATIC_FETCH_MIN_BYTES = 5000
+
+# Domains whose pages turned out to need a JS render; skip the static attempt
+# for them for a while (entries age out so a site redesign gets re-probed)
+_static_skip_domains: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Domains that recently 403'd on the regular browser; go straight to Browserbase
+_bb_domains: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Launch flags that strip Chromium features a headless scraper never uses;
+# --disable-dev-shm-usage keeps renders off the container's tiny /dev/shm
+CHROMIUM_ARGS = [
+    "--disable-dev-shm-usage",
+    "--no-zygote",
+    "--disable-gpu",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--disable-extensions",
+    "--mute-audio",
+    "--no-first-run",
+    "--disable-sync",
+    "--disable-translate",
+    "--metrics-recording-only",
+    "--no-pings",
+]
+
+BLOCKED_MEDIA_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.mp3", "*.mp4",
+    "*.avi", "*.flac", "*.ogg", "*.wav", "*.webm",
+]
+
+_MEDIA_RE = re.compile(r"\.(png|jpe?g|gif|svg|mp[34]|avi|flac|ogg|wav|webm)(\?|$)", re.I)
+
+async def _abort_media(route, request):
+    """Shared route handler used when CDP-level media blocking is unavailable."""
+    if _MEDIA_RE.search(request.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+class ContextPool:
+    """
+    Bounded pool of pre-warmed browser contexts.
+
+    A context is recycled (closed and replaced) after max_uses acquisitions
+    so the Playwright connection's per-context object registry can't grow
+    without bound across long-lived contexts.
+    """
+
+    def __init__(self, size: int, max_uses: int = CONTEXT_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._queue = asyncio.Queue(size)
+        self._uses: dict = {}
+
+    async def warm_up(self):
+        for _ in range(self.size):
+            await self._queue.put(await browser.new_context())
+
+    async def acquire(self):
+        context = await self._queue.get()
+        uses = self._uses.pop(context, 0) + 1
+        if uses > self.max_uses:
+            await context.close()
+            context = await browser.new_context()
+            uses = 1
+        self._uses[context] = uses
+        return context
+
+    async def release(self, context):
+        try:
+            await asyncio.gather(context.clear_cookies(), context.clear_permissions())
+        except Exception:
+            # The context died mid-request; replace it so the pool never
+            # shrinks below its fixed size (acquire() would block forever)
+            self._uses.pop(context, None)
+            try:
+                await context.close()
+            except Exception:
+                pass
+            context = await browser.new_context()
+        self._queue.put_nowait(context)
+
+    async def close(self):
+        while not self._queue.empty():
+            await self._queue.get_nowait().close()
+        self._uses.clear()
+
+async def block_media_via_cdp(cdp):
+    """
+    Block media requests natively in Chromium via CDP.
+
+    Unlike context.route(), Network.setBlockedURLs needs no Python round-trip
+    per blocked resource and leaves the browser HTTP cache enabled.
+    """
+    await cdp.send("Network.enable")
+    await cdp.send("Network.setBlockedURLs", {"urls": BLOCKED_MEDIA_URLS})
+
+async def _setup_media_blocking(page, cdp):
+    """Prefer CDP-native blocking, falling back to the shared route handler."""
+    try:
+        await block_media_via_cdp(cdp)
+    except Exception:
+        await page.route("**/*", _abort_media)
+
+async def get_page_html(cdp) -> str:
+    """
+    Read the serialized DOM over CDP.
+
+    Skips the page.content() JS bridge, which stringifies the document in
+    the page and ships it back as a JSON-escaped evaluate result.
+    """
+    doc = await cdp.send("DOM.getDocument", {"depth": 0})
+    result = await cdp.send("DOM.getOuterHTML", {"nodeId": doc["root"]["nodeId"]})
+    return result["outerHTML"]
 
 @app.on_event("startup")
 async def startup_event():
     """Event handler for application startup to initialize the browser."""
-    global browser
-    playwright = await async_playwright().start()
-    browser = await playwright.chromium.launch()
+    global browser, context_pool, http_client, playwright_instance, _access_log_task
+    _access_log_task = asyncio.create_task(_drain_access_log())
+    playwright_instance = await async_playwright().start()
+    browser = await playwright_instance.chromium.launch(args=CHROMIUM_ARGS)
+    context_pool = ContextPool(CONTEXT_POOL_SIZE)
+    await context_pool.warm_up()
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    )
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Event handler for application shutdown to close the browser."""
+    """Event handler for application shutdown to close the pooled contexts and browser."""
+    await context_pool.close()
     await browser.close()
+    for pool in bb_pools.values():
+        await pool.close()
+    await http_client.aclose()
+    await playwright_instance.stop()
+    if _access_log_task:
+        _access_log_task.cancel()
+    _log_listener.stop()
 
 @app.get("/health/liveness")
 def liveness_probe():
     """Endpoint for liveness probe."""
-    return JSONResponse(content={"status": "ok"}, status_code=200)
+    return {"status": "ok"}
 
 
 @app.get("/health/readiness")
 async def readiness_probe():
     """Endpoint for readiness probe. Checks if the browser instance is ready."""
     if browser:
-        return JSONResponse(content={"status": "ok"}, status_code=200)
-    return JSONResponse(content={"status": "Service Unavailable"}, status_code=503)
+        return {"status": "ok"}
+    return ORJSONResponse(content={"status": "Service Unavailable"}, status_code=503)
 
 
 @app.post("/html")
@@ -68,30 +329,112 @@ async def root(body: UrlModel):
     """
     Endpoint to fetch and return HTML content of a given URL.
 
+    Concurrency is bounded by a global semaphore, and identical in-flight
+    requests share a single fetch instead of launching duplicate navigations.
+
     Args:
         body (UrlModel): The URL model containing the target URL, wait time, and timeout.
 
     Returns:
-        JSONResponse: The HTML content of the page.
+        ORJSONResponse: The HTML content of the page.
     """
+    start = time.perf_counter()
+    key = (body.url, body.wait_after_load, frozenset((body.headers or {}).items()))
+    while (existing := _inflight.get(key)) is not None:
+        try:
+            result = await asyncio.shield(existing)
+        except asyncio.CancelledError:
+            # Only our own cancellation propagates; a cancelled *shared*
+            # future means the leader's client hung up mid-fetch, which
+            # shouldn't tear down waiters whose connections are healthy —
+            # drop the stale entry and let one of them become the leader
+            if not existing.cancelled():
+                raise
+            if _inflight.get(key) is existing:
+                _inflight.pop(key, None)
+            continue
+        _log_access(body.url, result.get("pageStatusCode"), start)
+        return _build_response(result, body)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
     try:
-        url_domain = urlparse(body.url).netloc
-        
-        if url_domain in ["twitter.com", "x.com"]:
-            body.url = await transform_twitter_url(body.url)
-        elif url_domain == "reddit.com" or url_domain.endswith(".reddit.com"):
-            return await handle_reddit_url(body)
-        elif url_domain == "linkedin.com" or url_domain.endswith(".linkedin.com"):
-            content = scrape_url_with_olostep(body.url)
-            return JSONResponse(content={"content": content, "pageStatusCode": 200, "pageError": ""})
-        elif url_domain == "crunchbase.com" or url_domain.endswith(".crunchbase.com"):
-            content = scrape_url_with_olostep(body.url)
-            return JSONResponse(content={"content": content, "pageStatusCode": 200, "pageError": ""})
-        elif url_domain == "dnb.com" or url_domain.endswith(".dnb.com"):
-            browserbase_result = await fetch_with_browserbase(body)
-            return JSONResponse(content=browserbase_result)
+        async with request_semaphore, _host_semaphores[_url_host(body.url)]:
+            result = await fetch_content(body)
+        fut.set_result(result)
+    except Exception as e:
+        # Propagate the leader's failure to any deduplicated waiters; mark
+        # the exception retrieved so the loop doesn't warn when nobody waits
+        fut.set_exception(e)
+        fut.exception()
+        raise
+    finally:
+        # Cancellation is a BaseException and skips the handler above;
+        # cancelling the future tells waiters to rerun the fetch themselves
+        if not fut.done():
+            fut.cancel()
+        _inflight.pop(key, None)
+    _log_access(body.url, result.get("pageStatusCode"), start)
+    return _build_response(result, body)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _build_response(result: dict, body: UrlModel):
+    """
+    Serialize a fetch result.
+
+    The default is the JSON payload the API service expects; callers that
+    set stream=true get the HTML chunked as text/html with the page status
+    and error carried in headers, avoiding a second full copy of multi-MB
+    documents inside a JSON string.
+    """
+    if not body.stream:
+        return ORJSONResponse(content=result)
+
+    data = result["content"].encode("utf-8")
+
+    def iter_chunks():
+        for i in range(0, len(data), STREAM_CHUNK_SIZE):
+            yield data[i:i + STREAM_CHUNK_SIZE]
+
+    return StreamingResponse(
+        iter_chunks(),
+        media_type="text/html",
+        headers={
+            "X-Page-Status": str(result["pageStatusCode"]),
+            "X-Page-Error": result["pageError"] or "",
+        },
+    )
+
+async def fetch_content(body: UrlModel):
+    """Run the full fetch pipeline for a URL and return the response payload."""
+    try:
+        url_domain = _url_host(body.url)
+
+        match classify_domain(url_domain):
+            case "twitter":
+                tweet_result = await fetch_tweet(body)
+                if tweet_result is not None:
+                    return tweet_result
+                # Not a tweet link; render it like any other page
+            case "reddit":
+                return await handle_reddit_url(body)
+            case "olostep":
+                content = await scrape_url_with_olostep(body.url)
+                return {"content": content, "pageStatusCode": 200, "pageError": ""}
+            case "browserbase":
+                return await fetch_with_browserbase(body)
+
+        # Skip the wasted regular-browser attempt on recently blocked domains
+        if _bb_domains.get(url_domain):
+            return await fetch_with_browserbase(body)
+
+        # Static pages don't need a browser render at all
+        if body.wait_after_load == 0 and not _static_skip_domains.get(url_domain):
+            static_result = await try_static_fetch(body, url_domain)
+            if static_result is not None:
+                return static_result
 
-        
         # First attempt with regular browser
         try:
             result = await fetch_with_regular_browser(body)
@@ -99,67 +442,156 @@ async def root(body: UrlModel):
             # If status code is 403, we'll use Browserbase instead
             if result["pageStatusCode"] == 403:
                 logger.info(f"Received 403 status for URL {body.url}. Attempting to fetch with Browserbase.")
+                _bb_domains[url_domain] = True
                 raise Exception("Received 403 status code")
-            
-            return JSONResponse(content=result)
+
+            _bb_domains.pop(url_domain, None)
+            return result
         except Exception as e:
             logger.error(f"Error with regular browser for URL {body.url}: {str(e)}")
             logger.error("Attempting to fetch with Browserbase as fallback")
-            return JSONResponse(content=await fetch_with_browserbase(body))
+            return await fetch_with_browserbase(body)
         
     except Exception as e:
-        logger.error(f"An error occurred while processing the request for URL: {body.url}")
-        logger.error(f"Request details: wait_after_load={body.wait_after_load}, timeout={body.timeout}, headers={body.headers}")
-        logger.error(f"Error details: {str(e)}", exc_info=True)
-        return JSONResponse(content={"content": "", "pageStatusCode": 500, "pageError": "Internal Server Error"})
+        logger.error(
+            "request_failed",
+            extra={
+                "url": body.url,
+                "wait_after_load": body.wait_after_load,
+                "timeout": body.timeout,
+                "err": str(e),
+            },
+            exc_info=True,
+        )
+        return {"content": "", "pageStatusCode": 500, "pageError": "Internal Server Error"}
 
-async def transform_twitter_url(url: str) -> str:
+def transform_twitter_url(url: str) -> str:
     """Transform Twitter URL to the corresponding API endpoint."""
-    tweet_id_match = re.search(r'/status/(\d+)', url)
+    tweet_id_match = _TWEET_RE.search(url)
     if not tweet_id_match:
         return url
         # raise HTTPException(status_code=400, detail="Invalid Twitter URL")
-    
-    tweet_id = tweet_id_match.group(1)
-    return f"https://cdn.syndication.twimg.com/tweet-result?id={tweet_id}&lang=en&features=tfw_timeline_list%3A%3Btfw_follower_count_sunset%3Atrue%3Btfw_tweet_edit_backend%3Aon%3Btfw_refsrc_session%3Aon%3Btfw_fosnr_soft_interventions_enabled%3Aon%3Btfw_show_birdwatch_pivots_enabled%3Aon%3Btfw_show_business_verified_badge%3Aon%3Btfw_duplicate_scribes_to_settings%3Aon%3Btfw_use_profile_image_shape_enabled%3Aon%3Btfw_show_blue_verified_badge%3Aon%3Btfw_legacy_timeline_sunset%3Atrue%3Btfw_show_gov_verified_badge%3Aon%3Btfw_show_business_affiliate_badge%3Aon%3Btfw_tweet_edit_frontend%3Aon&token=4c2mmul6mnh"
 
+    return _TWEET_URL_TMPL(tweet_id_match.group(1))
 
-async def fetch_with_regular_browser(body: UrlModel):
-    context = await browser.new_context()
 
-    if BLOCK_MEDIA:
-        await context.route(
-            "**/*.{png,jpg,jpeg,gif,svg,mp3,mp4,avi,flac,ogg,wav,webm}",
-            handler=lambda route, request: route.abort(),
+async def fetch_tweet(body: UrlModel):
+    """
+    Fetch tweet content straight from the syndication endpoint.
+
+    The endpoint serves JSON, so spinning up a browser context to GET it is
+    pure overhead. Returns None for Twitter URLs that aren't tweet links.
+    """
+    tweet_url = transform_twitter_url(body.url)
+    if tweet_url == body.url:
+        return None
+
+    response = await http_client.get(tweet_url, headers=body.headers or {})
+    return {
+        "content": response.text,
+        "pageStatusCode": response.status_code,
+        "pageError": _ERROR_CACHE.get(response.status_code)
+    }
+
+
+async def try_static_fetch(body: UrlModel, url_domain: str):
+    """
+    Attempt to fetch a page over plain HTTP before involving Playwright.
+
+    Returns the response payload when the page looks complete without a JS
+    render (HTML content type, non-error status, reasonably sized body that
+    actually closes the document), otherwise None so the caller falls back
+    to the browser. Domains whose responses were judged to need a render
+    are remembered in _static_skip_domains; transport errors are not, since
+    a DNS blip or timeout says nothing about the page itself.
+    """
+    try:
+        response = await http_client.get(
+            body.url,
+            headers=body.headers or {},
+            follow_redirects=True,
         )
+    except httpx.HTTPError:
+        return None
 
-    page = await context.new_page()
+    if response.status_code >= 400 or "text/html" not in response.headers.get("content-type", ""):
+        _static_skip_domains[url_domain] = True
+        return None
 
-    # Set headers if provided
-    if body.headers:
-        await page.set_extra_http_headers(body.headers)
+    raw = response.content
+    if (len(raw) < STATIC_FETCH_MIN_BYTES
+            or b"</html>" not in raw[-2048:].lower()
+            or b"__next_data__" in raw.lower()):
+        _static_skip_domains[url_domain] = True
+        return None
+
+    return {
+        "content": response.text,
+        "pageStatusCode": response.status_code,
+        "pageError": _ERROR_CACHE.get(response.status_code)
+    }
+
+async def fetch_with_regular_browser(body: UrlModel):
+    context = await context_pool.acquire()
+    page = None
+    try:
+        page = await context.new_page()
+        cdp = await context.new_cdp_session(page)
+
+        # Media blocking and header setup are independent commands; overlap
+        # them so pre-navigation setup costs one round-trip instead of two
+        setup = []
+        if BLOCK_MEDIA:
+            setup.append(_setup_media_blocking(page, cdp))
+        if body.headers:
+            setup.append(page.set_extra_http_headers(body.headers))
+        if setup:
+            await asyncio.gather(*setup)
+
+        # domcontentloaded returns as soon as the document is parsed; a short
+        # bounded networkidle wait then covers late subresources without
+        # blocking on the long tail of trackers the "load" event waits for
+        response = await page.goto(
+            body.url,
+            wait_until="domcontentloaded",
+            timeout=body.timeout,
+        )
+        page_status_code = response.status
+        page_error = _ERROR_CACHE.get(page_status_code)
+
+        # A 403 gets retried through Browserbase anyway; don't pay the
+        # post-load wait and content read for a result that will be discarded
+        if page_status_code == 403:
+            return {
+                "content": "",
+                "pageStatusCode": page_status_code,
+                "pageError": page_error
+            }
+
+        if body.wait_after_load > 0:
+            await page.wait_for_timeout(body.wait_after_load)
+        else:
+            try:
+                await page.wait_for_load_state("networkidle", timeout=2000)
+            except PlaywrightTimeoutError:
+                pass
+
+        page_content = await get_page_html(cdp)
+    finally:
+        if page:
+            try:
+                await page.close()
+            except Exception:
+                pass
+        await context_pool.release(context)
 
-    response = await page.goto(
-        body.url,
-        wait_until="load",
-        timeout=body.timeout,
-    )
-    page_status_code = response.status
-    page_error = get_error(page_status_code)
-    
-    if body.wait_after_load > 0:
-        await page.wait_for_timeout(body.wait_after_load)
-
-    page_content = await page.content()
-    await context.close()
-    
     return {
         "content": page_content,
         "pageStatusCode": page_status_code,
         "pageError": page_error
     }
 
-def generate_random_fingerprint():
+def _build_fingerprint():
     fingerprint = {}
 
     # Randomize operating systems
@@ -206,7 +638,13 @@ def generate_random_fingerprint():
 
     return fingerprint
 
-def create_session(useProxy: bool = False):
+# Sampling a fingerprint per session is pure overhead; draw from a pool built once
+_FINGERPRINTS = tuple(_build_fingerprint() for _ in range(256))
+
+def generate_random_fingerprint():
+    return random.choice(_FINGERPRINTS)
+
+async def create_session(useProxy: bool = False):
     url = "https://www.browserbase.com/v1/sessions"
     headers = {
         "Content-Type": "application/json",
@@ -220,23 +658,79 @@ def create_session(useProxy: bool = False):
         },
         "proxies": useProxy
     }
-    response = requests.post(url, json=json, headers=headers)
+    response = await http_client.post(url, json=json, headers=headers)
     return response.json()["id"]
 
+async def _connect_browserbase(proxy: bool = False) -> Browser:
+    ws_url = f"wss://connect.browserbase.com?apiKey={BROWSERBASE_API_KEY}"
+    if proxy:
+        ws_url += "&enableProxy=true"
+    return await playwright_instance.chromium.connect_over_cdp(ws_url)
+
+class BBPool:
+    """
+    Bounded pool of warm Browserbase CDP connections.
+
+    Connections are opened lazily up to the pool size so concurrent
+    requests don't serialize on a single shared WebSocket, and each one
+    is health-checked (and replaced) on acquire.
+    """
+
+    def __init__(self, size: int, proxy: bool = False):
+        self.size = size
+        self.proxy = proxy
+        self._queue = asyncio.Queue(size)
+        self._opened = 0
+
+    async def acquire(self) -> Browser:
+        # A failed connect must give its slot back, or BB_POOL_SIZE failed
+        # attempts (e.g. a Browserbase outage) exhaust the pool for good
+        if self._queue.empty() and self._opened < self.size:
+            self._opened += 1
+            try:
+                return await _connect_browserbase(self.proxy)
+            except Exception:
+                self._opened -= 1
+                raise
+        bb_browser = await self._queue.get()
+        if not bb_browser.is_connected():
+            try:
+                bb_browser = await _connect_browserbase(self.proxy)
+            except Exception:
+                self._opened -= 1
+                raise
+        return bb_browser
+
+    def release(self, bb_browser: Browser):
+        self._queue.put_nowait(bb_browser)
+
+    async def close(self):
+        while not self._queue.empty():
+            bb_browser = self._queue.get_nowait()
+            if bb_browser.is_connected():
+                await bb_browser.close()
+        self._opened = 0
+
+# Keep-alive Browserbase connection pools, keyed by whether the session proxies
+bb_pools = {
+    False: BBPool(BB_POOL_SIZE),
+    True: BBPool(BB_POOL_SIZE, proxy=True),
+}
+
 async def fetch_with_browserbase(body: UrlModel):
-    async with async_playwright() as playwright:
+    try:
+        # useProxy = any(domain in body.url for domain in PROXY_DOMAINS)
+        # session_id = create_session(useProxy)
+        bb_browser = await bb_pools[False].acquire()
         try:
-            # useProxy = any(domain in body.url for domain in PROXY_DOMAINS)
-            # session_id = create_session(useProxy)
-            chromium = playwright.chromium
-            browser = await chromium.connect_over_cdp(f"wss://connect.browserbase.com?apiKey={BROWSERBASE_API_KEY}")
-            # browser = await chromium.connect_over_cdp(f"wss://connect.browserbase.com?apiKey={BROWSERBASE_API_KEY}&sessionId={session_id}")
-            
-            context = browser.contexts[0]
-            page = context.pages[0]
-            
-            if body.headers:
-                await page.set_extra_http_headers(body.headers)
+            # Reuse the connection's default context and page; goto is far
+            # cheaper than new_context + new_page and keeps the renderer warm
+            context = bb_browser.contexts[0] if bb_browser.contexts else await bb_browser.new_context()
+            page = context.pages[0] if context.pages else await context.new_page()
+
+            # Always reset the extra headers: the page is reused across
+            # requests, so a previous caller's headers would leak otherwise
+            await page.set_extra_http_headers(body.headers or {})
 
             response = await page.goto(
                 body.url,
@@ -259,33 +753,51 @@ async def fetch_with_browserbase(body: UrlModel):
                     print("Timeout waiting for challenge validation to complete")
 
             page_status_code = response.status
-            page_error = get_error(page_status_code)
+            page_error = _ERROR_CACHE.get(page_status_code)
 
             if body.wait_after_load > 0:
                 await page.wait_for_timeout(body.wait_after_load)
 
             page_content = await page.content()
 
-            await context.close()
-            await page.close()
-            await browser.close()
-            
-            return {
-                "content": page_content,
-                "pageStatusCode": page_status_code,
-                "pageError": page_error
-            }
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An error occurred with Browserbase: {str(e)}")
+            if body.isolate:
+                await context.clear_cookies()
+
+            # Park the page so the next request starts from a blank document
+            await page.goto("about:blank")
+        finally:
+            bb_pools[False].release(bb_browser)
+
+        return {
+            "content": page_content,
+            "pageStatusCode": page_status_code,
+            "pageError": page_error
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred with Browserbase: {str(e)}")
 
 async def handle_reddit_url(body: UrlModel):
-    async with async_playwright() as playwright:
+    try:
+        bb_browser = await bb_pools[True].acquire()
+
+        context = page = None
         try:
-            chromium = playwright.chromium
-            browser = await chromium.connect_over_cdp(f"wss://connect.browserbase.com?apiKey={BROWSERBASE_API_KEY}&enableProxy=true")
-            
-            context = browser.contexts[0]
-            page = context.pages[0]
+            # Seed the context with warmed Reddit state when we have it, so the
+            # page skips the cookie/bootstrap dance before comments render
+            if path.exists(REDDIT_STORAGE_STATE):
+                try:
+                    context = await bb_browser.new_context(storage_state=REDDIT_STORAGE_STATE)
+                except Exception:
+                    # An unreadable state file must not take the whole Reddit
+                    # path down; drop it and start from a cold context
+                    logger.error("Discarding unreadable Reddit storage state", exc_info=True)
+                    try:
+                        remove(REDDIT_STORAGE_STATE)
+                    except OSError:
+                        pass
+            if context is None:
+                context = await bb_browser.new_context()
+            page = await context.new_page()
             # Set headers if provided
             if body.headers:
                 await page.set_extra_http_headers(body.headers)
@@ -297,87 +809,118 @@ async def handle_reddit_url(body: UrlModel):
 
             await page.wait_for_selector('shreddit-comment[depth="0"]', timeout=10000)
 
+            initial_count = await page.evaluate(
+                "document.querySelectorAll('shreddit-comment').length"
+            )
+
             await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
 
-            await page.wait_for_timeout(1000)
+            # Wait for the comments the scroll actually triggered instead of a
+            # fixed delay, settling for network idle when none arrive
+            try:
+                await page.wait_for_function(
+                    "count => document.querySelectorAll('shreddit-comment').length > count",
+                    arg=initial_count,
+                    timeout=2000,
+                )
+            except PlaywrightTimeoutError:
+                try:
+                    await page.wait_for_load_state("networkidle", timeout=1500)
+                except PlaywrightTimeoutError:
+                    pass
 
             page_status_code = response.status
-            page_error = get_error(page_status_code)
+            page_error = _ERROR_CACHE.get(page_status_code)
 
             reddit_data = await extract_reddit_data(page, body.url)
 
-            await context.close()
-            await page.close()
-            await browser.close()
-            json_compatible_item_data = {
-                "content": reddit_data,
-                "pageStatusCode": page_status_code,
-                "pageError": page_error
-            }
-            return JSONResponse(content=json_compatible_item_data)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-
-async def extract_reddit_data(page, url):
-    # Extract comments
-    comments = await page.evaluate("""
-        () => {
-            const commentElements = document.querySelectorAll('shreddit-comment[depth="0"]');
-            return Array.from(commentElements).map((comment) => {
-                const author = comment.getAttribute("author");
-                const contentElement = comment.querySelector(".md");
-                const content = contentElement ? contentElement.textContent.trim() : "";
-                const score = comment.getAttribute("score");
-                return { author, content, score };
-            });
+            # Persist the session state so the next request starts warm.
+            # Write-then-rename is atomic, so a concurrent reader never sees
+            # a torn file; the pid suffix keeps workers off each other's temp
+            try:
+                state = await context.storage_state()
+                tmp_path = f"{REDDIT_STORAGE_STATE}.{getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f)
+                replace(tmp_path, REDDIT_STORAGE_STATE)
+            except Exception:
+                logger.error("Could not persist Reddit storage state", exc_info=True)
+        finally:
+            # Close page and context concurrently; they're independent CDP calls
+            closers = [obj.close() for obj in (page, context) if obj]
+            if closers:
+                await asyncio.gather(*closers, return_exceptions=True)
+            bb_pools[True].release(bb_browser)
+
+        return {
+            "content": reddit_data,
+            "pageStatusCode": page_status_code,
+            "pageError": page_error
         }
-    """)
-
-    # Extract title and body
-    post_data = await page.evaluate("""
-        () => {
-            const titleElement = document.querySelector('h1[slot="title"]');
-            const bodyElement = document.querySelector('div[slot="text-body"] .md');
-            return {
-                title: titleElement?.textContent?.trim() || "Title not found",
-                body: bodyElement?.textContent?.trim() || "No text body found",
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+REDDIT_EXTRACT_JS = """
+    () => {
+        const commentElements = document.querySelectorAll('shreddit-comment[depth="0"]');
+        const comments = new Array(commentElements.length);
+        for (let i = 0; i < commentElements.length; i++) {
+            const comment = commentElements[i];
+            const contentElement = comment.querySelector(".md");
+            comments[i] = {
+                author: comment.getAttribute("author"),
+                content: contentElement ? contentElement.textContent.trim() : "",
+                score: comment.getAttribute("score"),
             };
         }
-    """)
+        const titleElement = document.querySelector('h1[slot="title"]');
+        const bodyElement = document.querySelector('div[slot="text-body"] .md');
+        return JSON.stringify({
+            title: titleElement?.textContent?.trim() || "Title not found",
+            body: bodyElement?.textContent?.trim() || "No text body found",
+            comments,
+        });
+    }
+"""
+
+async def extract_reddit_data(page, url):
+    # Extract the post and its comments in a single raw Runtime.evaluate:
+    # one CDP command, no Playwright evaluate wrapper, and the JSON string
+    # comes back by value inside the command response itself
+    session = await page.context.new_cdp_session(page)
+    result = await session.send("Runtime.evaluate", {
+        "expression": f"({REDDIT_EXTRACT_JS})()",
+        "returnByValue": True,
+        "awaitPromise": False,
+    })
+    post_data = json.loads(result["result"]["value"])
 
     # Format the response as markdown with XML tags
-    markdown_response = f"<title>{post_data['title']}</title>\n\n<body>{post_data['body']}</body>\n\n## Top Comments\n\n"
-    
-    for comment in comments:
-        # If you want to include author and score, uncomment the following line:
-        # markdown_response += f"<comment>\n<author>{comment['author']}</author>\n<score>{comment['score']}</score>\n<content>{comment['content']}</content>\n</comment>\n\n"
-        markdown_response += f"<comment>{comment['content']}</comment>\n\n"
-
-    return markdown_response
+    parts = [f"<title>{post_data['title']}</title>\n\n<body>{post_data['body']}</body>\n\n## Top Comments\n\n"]
+
+    # If you want to include author and score, emit
+    # <author>/<score>/<content> tags per comment instead
+    parts.extend(f"<comment>{comment['content']}</comment>\n\n" for comment in post_data["comments"])
+
+    return "".join(parts)
             
-def scrape_url_with_olostep(url: str):
-    params = {
-        "url": url,
-        "timeout": "20",
-        "waitBeforeScraping": "1",
-        "saveHtml": "false",
-        "saveMarkdown": "false",
-        "removeCSSselectors": "default",
-        "htmlTransformer": "true",
-        "removeImages": "true",
-        "expandMarkdown": "false",
-        "expandHtml": "true",
-        "fastLane": "true",
-    }
-    
-    url_to_scrape = f"https://agent.olostep.com/olostep-p2p-incomingAPI?{urlencode(params)}"
-    
+async def scrape_url_with_olostep(url: str):
+    url_to_scrape = f"https://agent.olostep.com/olostep-p2p-incomingAPI?url={quote_plus(url)}&{_OLOSTEP_STATIC_QS}"
+
     try:
-        response = requests.get(url_to_scrape, headers={
-            "Authorization": f"Bearer {OLOSTEP_API_KEY}"
-        })
+        response = await http_client.get(url_to_scrape, headers=_OLOSTEP_HEADERS)
         response.raise_for_status()
         data = response.json()
         return data.get("html_content", "")
-    except requests.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Failed to scrape website URL {url} with Olostep: {str(e)}")
\ No newline at end of file
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to scrape website URL {url} with Olostep: {str(e)}")
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(environ.get("PORT", "3000")),
+        loop="uvloop",
+        http="httptools",
+    )